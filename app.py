@@ -1,29 +1,49 @@
 import os
 import uuid
+import json
+import zlib
 import cv2
-import pickle
-import numpy as np
-import face_recognition
 from datetime import datetime
 from io import StringIO
 import csv
 from flask import (
     Flask, render_template, redirect, url_for,
-    flash, request, jsonify, Response
+    flash, request, jsonify, Response, stream_with_context
 )
 from flask_login import (
     LoginManager, login_user, login_required,
     logout_user
 )
-from flask_mail import Mail, Message
+from flask_mail import Mail
 from werkzeug.security import check_password_hash
-from models import db, Admin, Employee, Attendance
+from sqlalchemy.orm import contains_eager
+from models import db, Admin, Employee, Attendance, EnrollmentJob, day_range, upgrade_schema, configure_sqlite
 from config import Config
+from embedding_store import EmbeddingStore
+from gallery import FaceGallery
+from enrollment import EnrollmentQueue
+from recognition import decode_image, encode_best, encode_all, confidence
+from mailer import OutboxSender
+import metrics
+from metrics import stage, count
+from attendance import mark_attendance
+from rollups import present_count, monthly_department_report, absentees, forget_employee
 
 app = Flask(__name__)
 app.config.from_object(Config)
 db.init_app(app)
+configure_sqlite(app)
 mail = Mail(app)
+store = EmbeddingStore(app.config["EMBEDDINGS_FOLDER"])
+gallery = FaceGallery(store)
+enrollment = EnrollmentQueue(
+    app, gallery, app.config["ENROLL_WORKERS"],
+    save_frames=app.config["ENROLL_SAVE_FRAMES"],
+    heartbeat=app.config["ENROLL_HEARTBEAT"],
+)
+outbox = OutboxSender(app, mail)
+
+metrics.init_app(app)
 
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
@@ -54,7 +74,15 @@ def logout():
 @login_required
 def dashboard():
     employees = Employee.query.all()
-    return render_template("dashboard.html", employees=employees)
+    captured_count = sum(1 for e in employees if e.face_data_folder)
+    return render_template(
+        "dashboard.html",
+        employees=employees,
+        total_employees=len(employees),
+        captured_count=captured_count,
+        pending_count=len(employees) - captured_count,
+        present_today=present_count(datetime.utcnow().date()),
+    )
 
 @app.route("/employee/new", methods=["GET", "POST"])
 @login_required
@@ -99,10 +127,9 @@ def delete_employee(id):
         for file in os.listdir(emp.face_data_folder):
             os.remove(os.path.join(emp.face_data_folder, file))
         os.rmdir(emp.face_data_folder)
-    emb_path = os.path.join("static", "embeddings", f"{emp.id}_embeddings.pkl")
-    if os.path.exists(emb_path):
-        os.remove(emb_path)
+    gallery.remove(emp.id)
     try:
+        forget_employee(emp.id)
         db.session.delete(emp)
         db.session.commit()
         flash("Employee deleted.", "warning")
@@ -122,98 +149,166 @@ def capture_face(id):
         raw_folder = os.path.join("static", "captures", "raw")
         os.makedirs(raw_folder, exist_ok=True)
         raw_path = os.path.join(raw_folder, f"{uuid.uuid4()}.webm")
-        video.save(raw_path)
+        with stage("upload"):
+            video.save(raw_path)
         out_folder = os.path.join("static", "captures", str(emp.id))
-        os.makedirs(out_folder, exist_ok=True)
-
-        vid = cv2.VideoCapture(raw_path)
-        frame_count = 0
-        ear_threshold = 0.25
-        consecutive_frames = 0
-        saved_images = []
-
-        def eye_aspect_ratio(eye):
-            A = np.linalg.norm(eye[1] - eye[5])
-            B = np.linalg.norm(eye[2] - eye[4])
-            C = np.linalg.norm(eye[0] - eye[3])
-            return (A + B) / (2.0 * C)
-
-        while True:
-            ret, frame = vid.read()
-            if not ret:
-                break
-            if frame_count % 5 != 0:
-                frame_count += 1
-                continue
-            small = cv2.resize(frame, (0, 0), fx=0.5, fy=0.5)
-            rgb = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
-            landmarks_list = face_recognition.face_landmarks(rgb)
-            if landmarks_list:
-                lm = landmarks_list[0]
-                if "left_eye" in lm and "right_eye" in lm:
-                    left = np.array(lm["left_eye"])
-                    right = np.array(lm["right_eye"])
-                    ear = (eye_aspect_ratio(left) + eye_aspect_ratio(right)) / 2.0
-                    if ear < ear_threshold:
-                        consecutive_frames += 1
-                    else:
-                        if consecutive_frames >= 2:
-                            path = os.path.join(out_folder, f"{emp.id}_{frame_count}.jpg")
-                            cv2.imwrite(path, frame)
-                            saved_images.append(path)
-                        consecutive_frames = 0
-                else:
-                    if frame_count % 30 == 0:
-                        path = os.path.join(out_folder, f"{emp.id}_{frame_count}.jpg")
-                        cv2.imwrite(path, frame)
-                        saved_images.append(path)
-            frame_count += 1
 
-        vid.release()
-        os.remove(raw_path)
-        emp.face_data_folder = out_folder
+        now = datetime.utcnow()
+        job = EnrollmentJob(
+            id=str(uuid.uuid4()), employee_id=emp.id, status="queued",
+            created_at=now, updated_at=now, owner=enrollment.owner, raw_path=raw_path,
+        )
+        db.session.add(job)
         db.session.commit()
-
-        embeddings = []
-        for img_path in saved_images:
-            try:
-                encs = face_recognition.face_encodings(face_recognition.load_image_file(img_path))
-                if encs:
-                    embeddings.append(encs[0])
-            except Exception:
-                pass
-
-        emb_folder = os.path.join("static", "embeddings")
-        os.makedirs(emb_folder, exist_ok=True)
-        with open(os.path.join(emb_folder, f"{emp.id}_embeddings.pkl"), "wb") as f:
-            pickle.dump(embeddings, f)
-
-        return jsonify(message=f"Face data captured! {len(saved_images)} images, {len(embeddings)} embeddings saved"), 200
+        enrollment.submit(job.id, emp.id, raw_path, out_folder)
+        return jsonify(
+            message="Face capture queued for processing",
+            job_id=job.id,
+            status_url=url_for("capture_status", id=emp.id, job=job.id),
+        ), 202
 
     return render_template("capture.html", employee=emp)
 
-@app.route("/attendance_dashboard")
+@app.route("/capture/<int:id>/status")
 @login_required
-def attendance_dashboard():
+def capture_status(id):
+    # Jobs lost to a restart of another worker are failed here, lazily.
+    enrollment.fail_stale(app.config["ENROLL_JOB_TIMEOUT"])
+    q = EnrollmentJob.query.filter_by(employee_id=id)
+    job_id = request.args.get("job")
+    if job_id:
+        q = q.filter_by(id=job_id)
+    job = q.order_by(EnrollmentJob.created_at.desc()).first()
+    if not job:
+        return jsonify(message="No enrollment job found"), 404
+    if job.status == "done":
+        message = f"Face data captured! {job.image_count} images, {job.embedding_count} embeddings saved"
+    elif job.status == "failed":
+        message = f"Face capture failed: {job.error}"
+    else:
+        message = f"Face capture {job.status}..."
+    return jsonify(
+        job_id=job.id,
+        status=job.status,
+        image_count=job.image_count,
+        embedding_count=job.embedding_count,
+        error=job.error,
+        message=message,
+    ), 200
+
+def attendance_filters():
+    filters = []
     date = request.args.get("date")
     emp_name = request.args.get("employee")
-    q = Attendance.query.join(Employee)
     if date:
         try:
-            d = datetime.fromisoformat(date).date()
-            q = q.filter(db.func.date(Attendance.timestamp) == d)
+            start, end = day_range(datetime.fromisoformat(date).date())
+            filters += [Attendance.timestamp >= start, Attendance.timestamp < end]
+        except Exception:
+            pass
+    date_from = request.args.get("from")
+    if date_from:
+        try:
+            filters.append(Attendance.timestamp >= day_range(datetime.fromisoformat(date_from).date())[0])
+        except Exception:
+            pass
+    date_to = request.args.get("to")
+    if date_to:
+        try:
+            filters.append(Attendance.timestamp < day_range(datetime.fromisoformat(date_to).date())[1])
         except Exception:
             pass
     if emp_name:
-        q = q.filter(Employee.name.ilike(f"%{emp_name}%"))
-    records = q.order_by(Attendance.timestamp.desc()).all()
-    unique_days = {r.timestamp.date() for r in records}
+        filters.append(Employee.name.ilike(f"%{emp_name}%"))
+    return filters
+
+def filter_args():
+    # The query arguments attendance_filters() reads, for links that must
+    # keep the same filtered view (next page, export).
+    return {k: request.args[k] for k in ("date", "from", "to", "employee") if request.args.get(k)}
+
+def parse_cursor(cursor):
+    try:
+        ts, att_id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(ts), int(att_id)
+    except (AttributeError, ValueError):
+        return None
+
+@app.route("/attendance_dashboard")
+@login_required
+def attendance_dashboard():
+    filters = attendance_filters()
+    total_count, unique_employees_count, unique_days_count = db.session.execute(
+        db.select(
+            db.func.count(Attendance.id),
+            db.func.count(db.distinct(Attendance.employee_id)),
+            db.func.count(db.distinct(Attendance.day)),
+        ).select_from(Attendance).join(Employee).where(*filters)
+    ).one()
+
+    q = (
+        Attendance.query.join(Employee)
+        .options(contains_eager(Attendance.employee))
+        .filter(*filters)
+    )
+    after = parse_cursor(request.args.get("after"))
+    if after:
+        ts, att_id = after
+        q = q.filter(db.or_(
+            Attendance.timestamp < ts,
+            db.and_(Attendance.timestamp == ts, Attendance.id < att_id),
+        ))
+    page_size = app.config["ATTENDANCE_PAGE_SIZE"]
+    records = q.order_by(Attendance.timestamp.desc(), Attendance.id.desc()).limit(page_size + 1).all()
+    start = request.args.get("start", 0, type=int) if after else 0
+    next_url = None
+    if len(records) > page_size:
+        records = records[:page_size]
+        last = records[-1]
+        next_url = url_for(
+            "attendance_dashboard",
+            **filter_args(),
+            after=f"{last.timestamp.isoformat()}_{last.id}",
+            start=start + page_size,
+        )
     return render_template(
         "attendance_dashboard.html",
         records=records,
-        unique_days_count=len(unique_days)
+        start=start,
+        next_url=next_url,
+        filter_args=filter_args(),
+        total_count=total_count,
+        unique_employees_count=unique_employees_count,
+        unique_days_count=unique_days_count
     )
 
+def recognize_and_mark(frames):
+    encoding, _ = encode_best(frames, scale=app.config["RECOGNITION_SCALE"])
+    if encoding is None:
+        count("attendance_recognitions_total", result="no_face")
+        return jsonify(message="No face detected"), 400
+    tolerance = app.config["FACE_MATCH_TOLERANCE"]
+    with stage("match"):
+        gallery.ensure_fresh()
+        match = gallery.match(encoding, tolerance=tolerance, min_margin=app.config["FACE_MATCH_MARGIN"])
+    with stage("db"):
+        recognized = db.session.get(Employee, match.employee_id) if match else None
+    if not recognized:
+        count("attendance_recognitions_total", result="rejected")
+        return jsonify(message="Invalid Face – Attendance Not Marked"), 400
+    # mark_attendance times its own "db" and "mail" stages.
+    if not mark_attendance(recognized, datetime.utcnow(), digest=app.config["MAIL_DIGEST"]):
+        db.session.rollback()
+        count("attendance_recognitions_total", result="duplicate")
+        return jsonify(message="Attendance already marked today"), 409
+    with stage("db"):
+        db.session.commit()
+    count("attendance_recognitions_total", result="recognized")
+    return jsonify(
+        message=f"Attendance Marked! {recognized.name}",
+        confidence=confidence(match, tolerance),
+    ), 200
+
 @app.route("/attendance_mark", methods=["GET", "POST"])
 def attendance_mark_page():
     if request.method == "POST":
@@ -222,82 +317,181 @@ def attendance_mark_page():
             return jsonify(message="No video"), 400
         import tempfile
         tmp = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}.webm")
-        video.save(tmp)
-        vid = cv2.VideoCapture(tmp)
-        ret, frame = vid.read()
-        vid.release()
+        with stage("upload"):
+            video.save(tmp)
+        with stage("decode"):
+            vid = cv2.VideoCapture(tmp)
+            ret, frame = vid.read()
+            vid.release()
         os.remove(tmp)
         if not ret:
             return jsonify(message="No frame detected"), 400
-        encs = face_recognition.face_encodings(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-        if not encs:
-            return jsonify(message="No face detected"), 400
-        live = encs[0]
-        recognized = None
-        for emp in Employee.query.all():
-            p = os.path.join("static", "embeddings", f"{emp.id}_embeddings.pkl")
-            if os.path.exists(p):
-                with open(p, "rb") as f:
-                    stored = pickle.load(f)
-                if any(face_recognition.compare_faces(stored, live, tolerance=0.6)):
-                    recognized = emp
-                    break
-        if not recognized:
-            return jsonify(message="Invalid Face – Attendance Not Marked"), 400
-        today = datetime.utcnow().date()
-        if Attendance.query.filter(
-            Attendance.employee_id == recognized.id,
-            db.func.date(Attendance.timestamp) == today
-        ).first():
-            return jsonify(message="Attendance already marked today"), 409
-        att = Attendance(employee_id=recognized.id, timestamp=datetime.utcnow())
-        db.session.add(att)
-        db.session.commit()
-        try:
-            msg = Message("Attendance Confirmation",
-                          sender=app.config["MAIL_USERNAME"],
-                          recipients=[recognized.email])
-            msg.body = f"Your attendance was marked at {att.timestamp.strftime('%Y-%m-%d %H:%M:%S')}"
-            mail.send(msg)
-        except Exception:
-            pass
-        return jsonify(message=f"Attendance Marked! {recognized.name}"), 200
+        return recognize_and_mark([frame])
     return render_template("attendance_mark.html")
 
-@app.route("/export_attendance_csv")
+@app.route("/attendance_mark/frame", methods=["POST"])
+def attendance_mark_frame():
+    uploads = request.files.getlist("frame")[:app.config["RECOGNITION_MAX_FRAMES"]]
+    with stage("upload"):
+        data = [f.read() for f in uploads]
+    with stage("decode"):
+        frames = [decode_image(d) for d in data]
+    if not any(f is not None for f in frames):
+        return jsonify(message="No frame detected"), 400
+    return recognize_and_mark(frames)
+
+@app.route("/attendance_mark/group", methods=["POST"])
+def attendance_mark_group():
+    # One camera frame, every face in it: batch encode, one vectorized match,
+    # one transaction for everybody recognized.
+    upload = request.files.get("frame")
+    with stage("upload"):
+        data = upload.read() if upload else b""
+    with stage("decode"):
+        frame = decode_image(data)
+    if frame is None:
+        return jsonify(message="No frame detected"), 400
+    faces = encode_all(frame, scale=app.config["RECOGNITION_SCALE"], max_faces=app.config["GROUP_MAX_FACES"])
+    if not faces:
+        count("attendance_recognitions_total", result="no_face")
+        return jsonify(message="No face detected", faces=[]), 400
+    tolerance = app.config["FACE_MATCH_TOLERANCE"]
+    with stage("match"):
+        gallery.ensure_fresh()
+        matches = gallery.match_many([enc for _, enc, _ in faces], tolerance=tolerance,
+                                     min_margin=app.config["FACE_MATCH_MARGIN"])
+    # The same person can only be marked once per frame; keep the closest face.
+    closest = {}
+    for i, m in enumerate(matches):
+        if m and (m.employee_id not in closest or m.distance < matches[closest[m.employee_id]].distance):
+            closest[m.employee_id] = i
+    results = []
+    now = datetime.utcnow()
+    with stage("db"):
+        employees = {e.id: e for e in Employee.query.filter(Employee.id.in_(list(closest))).all()} if closest else {}
+    for i, ((top, right, bottom, left), _, _) in enumerate(faces):
+        m = matches[i]
+        emp = employees.get(m.employee_id) if m and closest.get(m.employee_id) == i else None
+        face = {"box": [top, right, bottom, left]}
+        if emp is None:
+            face["status"] = "unknown" if not m or m.employee_id not in employees else "repeated"
+        else:
+            marked = mark_attendance(emp, now, digest=app.config["MAIL_DIGEST"])
+            face.update(
+                status="marked" if marked else "duplicate",
+                employee_id=emp.id,
+                name=emp.name,
+                confidence=confidence(m, tolerance),
+            )
+        count("attendance_recognitions_total", result={
+            "marked": "recognized", "unknown": "rejected"}.get(face["status"], "duplicate"))
+        results.append(face)
+    with stage("db"):
+        db.session.commit()
+    marked = [f["name"] for f in results if f["status"] == "marked"]
+    message = f"Attendance Marked! {', '.join(marked)}" if marked else "No new attendance marked"
+    return jsonify(message=message, faces=results), 200
+
+@app.route("/reports")
 @login_required
-def export_csv():
-    date = request.args.get("date")
-    emp_name = request.args.get("employee")
-    q = Attendance.query.join(Employee)
-    if date:
-        try:
-            d = datetime.fromisoformat(date).date()
-            q = q.filter(db.func.date(Attendance.timestamp) == d)
-        except Exception:
-            pass
-    if emp_name:
-        q = q.filter(Employee.name.ilike(f"%{emp_name}%"))
-    records = q.order_by(Attendance.timestamp.desc()).all()
+def reports():
+    today = datetime.utcnow().date()
+    try:
+        year, month = map(int, request.args.get("month", "").split("-"))
+        month_start = datetime(year, month, 1).date()
+    except ValueError:
+        month_start = today.replace(day=1)
+    try:
+        day = datetime.fromisoformat(request.args.get("date", "")).date()
+    except ValueError:
+        day = today
+    working_days, department_report = monthly_department_report(month_start.year, month_start.month)
+    return render_template(
+        "reports.html",
+        month=month_start.strftime("%Y-%m"),
+        day=day.isoformat(),
+        working_days=working_days,
+        department_report=department_report,
+        absent=absentees(day),
+    )
+
+def export_rows(fmt, rows):
+    # Rows are written in chunks of 500 so the response starts immediately
+    # without paying a write per row.
     output = StringIO()
+    if fmt == "ndjson":
+        for i, r in enumerate(rows, 1):
+            output.write(json.dumps({
+                "employee_id": r.employee_id,
+                "name": r.name,
+                "department": r.department,
+                "date": r.timestamp.strftime('%Y-%m-%d'),
+                "time": r.timestamp.strftime('%H:%M:%S'),
+            }) + "\n")
+            if i % 500 == 0:
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate()
+        yield output.getvalue()
+        return
     writer = csv.writer(output)
     writer.writerow(["Name","Department","Date","Time"])
-    for r in records:
+    for i, r in enumerate(rows, 1):
         writer.writerow([
-            r.employee.name,
-            r.employee.department,
+            r.name,
+            r.department,
             r.timestamp.strftime('%Y-%m-%d'),
             r.timestamp.strftime('%H:%M:%S')
         ])
-    csv_data = output.getvalue()
-    output.close()
+        if i % 500 == 0:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue()
+
+def gzip_chunks(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = z.compress(chunk.encode())
+        if data:
+            yield data
+    yield z.flush()
+
+@app.route("/export_attendance_csv")
+@login_required
+def export_csv():
+    fmt = request.args.get("format", "csv")
+    if fmt not in ("csv", "ndjson"):
+        return jsonify(message="Unsupported export format"), 400
+    use_gzip = request.args.get("gzip") in ("1", "true")
+    stmt = (
+        db.select(Attendance.employee_id, Attendance.timestamp, Employee.name, Employee.department)
+        .join(Employee)
+        .where(*attendance_filters())
+        .order_by(Attendance.timestamp.desc(), Attendance.id.desc())
+        .execution_options(yield_per=app.config["EXPORT_BATCH_SIZE"])
+    )
+
+    def generate():
+        chunks = export_rows(fmt, db.session.execute(stmt))
+        yield from gzip_chunks(chunks) if use_gzip else chunks
+
+    filename = f"attendance_records.{fmt}" + (".gz" if use_gzip else "")
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
     return Response(
-        csv_data,
-        mimetype="text/csv",
-        headers={"Content-disposition":"attachment;filename=attendance_records.csv"}
+        stream_with_context(generate()),
+        mimetype="application/gzip" if use_gzip else mimetype,
+        headers={"Content-disposition":f"attachment;filename={filename}"}
     )
 
 if __name__ == "__main__":
     with app.app_context():
         db.create_all()
+        upgrade_schema()
+        # The dev server is the only process, so nothing queued survived.
+        enrollment.fail_stale(0)
+    # The debug reloader runs this block in two processes; only the serving
+    # child should deliver mail. Use "python mailer.py" under gunicorn.
+    if app.config["MAIL_OUTBOX_SENDER"] and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        outbox.start()
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,59 @@
+import sys
+import logging
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, Attendance, SAME_DAY_DUPLICATES, add_day_column, upgrade_schema
+from mailer import enqueue
+from metrics import stage
+from rollups import record_punch, backfill
+
+log = logging.getLogger(__name__)
+
+
+def mark_attendance(employee, timestamp, digest=False):
+    # Insert-or-conflict on (employee_id, day): concurrent kiosks race on the
+    # unique index instead of a check-then-insert. Returns False when the
+    # employee is already marked for that day. The caller commits.
+    with stage("db"):
+        inserted = db.session.execute(
+            sqlite_insert(Attendance)
+            .values(employee_id=employee.id, timestamp=timestamp, day=timestamp.date())
+            .on_conflict_do_nothing(index_elements=["employee_id", "day"])
+        ).rowcount
+    if not inserted:
+        return False
+    with stage("mail"):
+        enqueue(
+            employee.email,
+            "Attendance Confirmation",
+            f"Your attendance was marked at {timestamp.strftime('%Y-%m-%d %H:%M:%S')}",
+            digest=digest,
+        )
+    with stage("db"):
+        record_punch(employee, timestamp)
+    return True
+
+
+def dedupe():
+    # One-off cleanup for databases from before the (employee_id, day)
+    # unique index: keeps each employee's first punch of the day, deletes
+    # the rest, rebuilds the rollups and then builds the index.
+    add_day_column()
+    ids = db.session.scalars(db.text(SAME_DAY_DUPLICATES)).all()
+    if ids:
+        log.warning("Deleting %d same-day duplicate attendance rows: ids %s", len(ids), ids)
+        db.session.execute(db.text(f"DELETE FROM attendance WHERE id IN ({SAME_DAY_DUPLICATES})"))
+        db.session.commit()
+    log.info("Rebuilt %d employee-day rollups", backfill())
+    upgrade_schema()
+    return ids
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["dedupe"]:
+        print("usage: python attendance.py dedupe")
+        sys.exit(2)
+    logging.basicConfig(level=logging.INFO)
+    from app import app
+    with app.app_context():
+        db.create_all()
+        print(f"Removed {len(dedupe())} duplicate attendance rows")
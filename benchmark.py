@@ -0,0 +1,358 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+import numpy as np
+import cv2
+
+# Usage:
+#   python benchmark.py --output before.json
+#   python benchmark.py --output after.json --compare before.json
+# Everything runs offline on CPU against a throwaway database and gallery
+# in a temp directory, which is also the working directory so /capture
+# writes its clips and frames there. The sample stills and webm clips in
+# static/captures are only read; data/ and static/ are never written.
+
+
+def percentiles(samples):
+    a = np.asarray(samples) * 1000.0
+    return {
+        "n": len(a),
+        "mean_ms": round(float(a.mean()), 4),
+        "p50_ms": round(float(np.percentile(a, 50)), 4),
+        "p95_ms": round(float(np.percentile(a, 95)), 4),
+        "p99_ms": round(float(np.percentile(a, 99)), 4),
+    }
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def synthetic_embeddings(rng, employees, per_employee):
+    # Random unit-ish vectors spread like dlib encodings (norm around 1).
+    centers = rng.normal(0, 0.09, size=(employees, 128)).astype(np.float32)
+    noise = rng.normal(0, 0.02, size=(employees, per_employee, 128)).astype(np.float32)
+    return centers, centers[:, None, :] + noise
+
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "captures")
+
+
+def sample_faces():
+    # The enrolled sample stills shipped in static/captures/<id>/: the last
+    # image of each employee is held out as the kiosk probe, the rest form
+    # that employee's gallery entry.
+    faces = {}
+    for name in sorted(os.listdir(SAMPLES)):
+        folder = os.path.join(SAMPLES, name)
+        if name.isdigit() and os.path.isdir(folder):
+            images = sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".jpg"))
+            if len(images) >= 2:
+                faces[int(name)] = images
+    return faces
+
+
+def sample_clips():
+    folder = os.path.join(SAMPLES, "raw")
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".webm"))
+
+
+def bench_gallery(workdir, sizes, per_employee, queries, rng):
+    from embedding_store import EmbeddingStore
+    from gallery import FaceGallery
+    results = {}
+    for size in sizes:
+        folder = os.path.join(workdir, f"gallery_{size}")
+        store = EmbeddingStore(folder)
+        centers, rows = synthetic_embeddings(rng, size, per_employee)
+        start = time.perf_counter()
+        store.put_many({i + 1: rows[i] for i in range(size)})
+        build = time.perf_counter() - start
+        gallery = FaceGallery(store)
+        start = time.perf_counter()
+        gallery.load()
+        load = time.perf_counter() - start
+        probes = centers[rng.integers(0, size, size=queries)] + rng.normal(0, 0.02, (queries, 128)).astype(np.float32)
+        it = iter(probes)
+        results[str(size)] = {
+            "rows": len(gallery),
+            "build_s": round(build, 4),
+            "load_s": round(load, 4),
+            "match": timed(lambda: gallery.match(next(it)), queries),
+        }
+    return results
+
+
+def seed_history(app, employees, days, per_day_fraction, rng):
+    from werkzeug.security import generate_password_hash
+    from models import db, Admin, Employee, Attendance, upgrade_schema
+    from rollups import backfill
+    departments = ["Engineering", "Sales", "Support", "Operations", "Finance"]
+    with app.app_context():
+        db.create_all()
+        upgrade_schema()
+        db.session.add(Admin(username="bench", password_hash=generate_password_hash("bench")))
+        db.session.execute(db.insert(Employee), [
+            {"id": i, "name": f"Employee {i}", "department": departments[i % len(departments)],
+             "email": f"employee{i}@example.com", "contact": "0000000000"}
+            for i in range(1, employees + 1)
+        ])
+        start_day = datetime(2024, 1, 1, 8, 0)
+        total = 0
+        for d in range(days):
+            present = np.flatnonzero(rng.random(employees) < per_day_fraction) + 1
+            offsets = rng.integers(0, 3 * 3600, size=len(present))
+            day = start_day + timedelta(days=d)
+            db.session.execute(db.insert(Attendance), [
+                {"employee_id": int(e), "timestamp": day + timedelta(seconds=int(o)), "day": day.date()}
+                for e, o in zip(present, offsets)
+            ])
+            total += len(present)
+        db.session.commit()
+        backfill()
+    return total
+
+
+def reset_today(app):
+    # Each kiosk request should run the full insert path, not hit the
+    # already-marked-today conflict left by the previous iteration.
+    from models import db, Attendance, DailyAttendance, DailyDepartmentAttendance, OutboxMessage
+    today = datetime.utcnow().date()
+    with app.app_context():
+        db.session.execute(db.delete(Attendance).where(Attendance.day == today))
+        db.session.execute(db.delete(DailyAttendance).where(DailyAttendance.day == today))
+        db.session.execute(db.delete(DailyDepartmentAttendance).where(DailyDepartmentAttendance.day == today))
+        db.session.execute(db.delete(OutboxMessage))
+        db.session.commit()
+
+
+def timed_requests(app, send, payloads, repeat):
+    samples, statuses = [], {}
+    for i in range(repeat):
+        reset_today(app)
+        start = time.perf_counter()
+        response = send(payloads[i % len(payloads)])
+        samples.append(time.perf_counter() - start)
+        statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+    return dict(percentiles(samples), status_codes=statuses)
+
+
+def bench_recognition(app, client, gallery_size, per_employee, frames, repeat, rng):
+    # A synthetic gallery of gallery_size employees with the real sample
+    # employees enrolled from their stills, probed with a held-out still
+    # (single-face frame endpoint) and the recorded webm clips (video
+    # endpoint), so decode -> detect -> encode -> match -> db all run.
+    import face_recognition
+    from app import gallery
+    centers, rows = synthetic_embeddings(rng, gallery_size, per_employee)
+    real = sample_faces()
+    gallery.store.put_many({i + 1: rows[i] for i in range(gallery_size) if i + 1 not in real})
+    probes = []
+    for emp_id, images in real.items():
+        encodings = [
+            e for path in images[:-1]
+            for e in face_recognition.face_encodings(face_recognition.load_image_file(path))[:1]
+        ]
+        gallery.store.put(emp_id, np.asarray(encodings, dtype=np.float32).reshape(-1, 128))
+        with open(images[-1], "rb") as f:
+            probes.append(f.read())
+    gallery.load()
+
+    clips = []
+    for path in sample_clips():
+        with open(path, "rb") as f:
+            clips.append(f.read())
+
+    def post_frames(data):
+        files = {"frame": [(io.BytesIO(data), f"f{i}.jpg") for i in range(frames)]}
+        return client.post("/attendance_mark/frame", data=files, content_type="multipart/form-data")
+
+    def post_video(data):
+        return client.post("/attendance_mark", data={"video": (io.BytesIO(data), "clip.webm")},
+                           content_type="multipart/form-data")
+
+    queries = iter(centers[rng.integers(0, gallery_size, size=repeat)])
+    results = {
+        "gallery_rows": len(gallery),
+        "sample_employees": sorted(real),
+        "match": timed(lambda: gallery.match(next(queries)), repeat),
+    }
+    if probes:
+        results["frame_endpoint"] = timed_requests(app, post_frames, probes, repeat)
+    if clips:
+        results["video_endpoint"] = timed_requests(app, post_video, clips, repeat)
+    reset_today(app)
+    return results
+
+
+def bench_enrollment(app, client, clips, timeout=300):
+    # POST /capture/<id> with the recorded webm clips and poll the job until
+    # it finishes: upload, frame loop, encode and gallery write end to end.
+    # The first clip also pays for starting the process pool, reported apart.
+    samples, statuses = [], {}
+    first = None
+    for i, path in enumerate(sample_clips()[:clips]):
+        with open(path, "rb") as f:
+            data = f.read()
+        start = time.perf_counter()
+        response = client.post("/capture/1", data={"video": (io.BytesIO(data), "clip.webm")},
+                               content_type="multipart/form-data")
+        status = "failed"
+        if response.status_code == 202:
+            status_url = response.get_json()["status_url"]
+            while time.perf_counter() - start < timeout:
+                status = client.get(status_url).get_json()["status"]
+                if status in ("done", "failed"):
+                    break
+                time.sleep(0.02)
+        elapsed = time.perf_counter() - start
+        statuses[status] = statuses.get(status, 0) + 1
+        if i == 0:
+            first = round(elapsed, 4)
+        else:
+            samples.append(elapsed)
+    return {
+        "first_clip_s": first,
+        "per_clip": percentiles(samples) if samples else None,
+        "job_statuses": statuses,
+    }
+
+
+def drain(response):
+    size = 0
+    for chunk in response.response:
+        size += len(chunk)
+    response.close()
+    return size
+
+
+def bench_reports(client, repeat, sample_day):
+    out = {
+        "dashboard_unfiltered": timed(lambda: client.get("/attendance_dashboard"), repeat),
+        "dashboard_by_date": timed(lambda: client.get(f"/attendance_dashboard?date={sample_day}"), repeat),
+        "reports": timed(lambda: client.get(f"/reports?month={sample_day[:7]}&date={sample_day}"), repeat),
+    }
+    for fmt, query in (("csv", ""), ("ndjson", "?format=ndjson"), ("csv_gzip", "?gzip=1")):
+        start = time.perf_counter()
+        size = drain(client.get(f"/export_attendance_csv{query}", buffered=False))
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        drain(client.get(f"/export_attendance_csv{query}", buffered=False))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        out[f"export_{fmt}"] = {
+            "bytes": size,
+            "seconds": round(elapsed, 4),
+            "mb_per_s": round(size / elapsed / 1e6, 2) if elapsed else None,
+            "peak_traced_mb": round(peak / 1e6, 2),
+        }
+    return out
+
+
+def flatten(d, prefix=""):
+    for k, v in d.items():
+        key = f"{prefix}.{k}" if prefix else k
+        if isinstance(v, dict):
+            yield from flatten(v, key)
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            yield key, v
+
+
+def compare(old, new):
+    before = dict(flatten(old["results"]))
+    for key, value in flatten(new["results"]):
+        if key in before and before[key]:
+            print(f"{key:70s} {before[key]:>12.4f} -> {value:>12.4f}  ({value / before[key]:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recognition, enrollment and reporting paths.")
+    parser.add_argument("--gallery-sizes", default="500,5000,20000")
+    parser.add_argument("--per-employee", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--employees", type=int, default=1000, help="employees in the synthetic history")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--presence", type=float, default=0.9)
+    parser.add_argument("--frames", type=int, default=3, help="frames per recognition request")
+    parser.add_argument("--clips", type=int, default=3, help="sample webm clips to enroll through /capture")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", default="benchmark_report.json")
+    parser.add_argument("--compare", help="previous report to compare against")
+    args = parser.parse_args()
+    args.output = os.path.abspath(args.output)
+    if args.compare:
+        args.compare = os.path.abspath(args.compare)
+
+    rng = np.random.default_rng(args.seed)
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="attendance-bench-")
+    os.chdir(workdir)
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(workdir, "bench.db")
+    os.environ["EMBEDDINGS_FOLDER"] = os.path.join(workdir, "embeddings")
+    try:
+        from app import app
+        app.config.update(SLOW_REQUEST_SECONDS=float("inf"))
+        results = {}
+
+        print("gallery matching...", file=sys.stderr)
+        sizes = [int(s) for s in args.gallery_sizes.split(",") if s]
+        results["gallery"] = bench_gallery(workdir, sizes, args.per_employee, args.queries, rng)
+
+        print("seeding attendance history...", file=sys.stderr)
+        start = time.perf_counter()
+        rows = seed_history(app, args.employees, args.days, args.presence, rng)
+        results["history"] = {"rows": rows, "seed_s": round(time.perf_counter() - start, 2)}
+
+        client = app.test_client()
+        client.post("/login", data={"username": "bench", "password": "bench"})
+
+        print("recognition endpoint...", file=sys.stderr)
+        results["recognition"] = bench_recognition(
+            app, client, args.employees, args.per_employee, args.frames, args.repeat, rng
+        )
+
+        print("enrollment...", file=sys.stderr)
+        results["enrollment"] = bench_enrollment(app, client, args.clips)
+
+        print("dashboard and export...", file=sys.stderr)
+        results["reports"] = bench_reports(client, args.repeat, "2024-06-03")
+
+        report = {
+            "meta": {
+                "timestamp": datetime.utcnow().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "opencv": cv2.__version__,
+                "cpu_count": os.cpu_count(),
+                "machine": platform.machine(),
+                "args": vars(args),
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}", file=sys.stderr)
+        if args.compare:
+            with open(args.compare) as f:
+                compare(json.load(f), report)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
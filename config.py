@@ -3,8 +3,16 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 
 class Config:
     SECRET_KEY = 'ENTER YOUR SECRET KEY '
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir,'data','employees.db')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(basedir,'data','employees.db'))
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLITE_WAL = True
+    SQLITE_BUSY_TIMEOUT = 30
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_timeout': 30,
+        'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT, 'check_same_thread': False},
+    }
     
     MAIL_SERVER = 'smtp.gmail.com'
     MAIL_PORT = 587
@@ -12,3 +20,38 @@ class Config:
     MAIL_USERNAME = 'ENTER YOUR USERNAME'
     MAIL_PASSWORD = 'ENTER YOUR PASSWORD'
     MAIL_DEFAULT_SENDER ='ENTER EMAIL'
+    MAIL_OUTBOX_SENDER = True
+    MAIL_OUTBOX_INTERVAL = 5
+    MAIL_OUTBOX_BATCH_SIZE = 50
+    MAIL_OUTBOX_MAX_ATTEMPTS = 5
+    MAIL_OUTBOX_BACKOFF = 30
+    MAIL_OUTBOX_LEASE = 300
+    MAIL_DIGEST = False
+
+    EMBEDDINGS_FOLDER = os.environ.get('EMBEDDINGS_FOLDER', os.path.join('static','embeddings'))
+    FACE_MATCH_TOLERANCE = 0.6
+    FACE_MATCH_MARGIN = 0.0
+    RECOGNITION_SCALE = 0.5
+    RECOGNITION_MAX_FRAMES = 5
+    GROUP_MAX_FACES = 20
+
+    SLOW_REQUEST_SECONDS = 1.0
+    # Shared directory for per-worker metric dumps when running several
+    # gunicorn workers; empty it on deploy. Unset: single-process metrics.
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+
+    ATTENDANCE_PAGE_SIZE = 50
+    EXPORT_BATCH_SIZE = 1000
+
+    # Pool size per web process: under gunicorn every worker gets its own
+    # pool, so N workers can run N x ENROLL_WORKERS dlib processes at once.
+    # Set ENROLL_WORKERS to roughly (cores - 1) / N there.
+    ENROLL_WORKERS = int(os.environ.get('ENROLL_WORKERS', max(1, (os.cpu_count() or 2) - 1)))
+    # The process holding a job refreshes it every ENROLL_HEARTBEAT seconds;
+    # a queued/running job not refreshed for ENROLL_JOB_TIMEOUT was lost to
+    # a restart or worker recycle.
+    ENROLL_HEARTBEAT = 30
+    ENROLL_JOB_TIMEOUT = 180
+    # Keep the chosen frames on disk so extract_embeddings.py can rebuild
+    # the gallery later; they are written off the encoding path.
+    ENROLL_SAVE_FRAMES = True
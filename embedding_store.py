@@ -0,0 +1,268 @@
+import os
+import sys
+import json
+import time
+import pickle
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+EMBEDDINGS_FOLDER = os.path.join("static", "embeddings")
+INDEX_NAME = "gallery.json"
+LOCK_NAME = "gallery.lock"
+
+
+class EmbeddingStore:
+    # On-disk gallery: one append-only float32 matrix plus a small JSON index
+    # of employee id -> (offset, count, version). Readers memory-map the data
+    # file; writers serialize on a lock file and publish by atomically
+    # replacing the index, so a reader always sees a consistent snapshot.
+
+    def __init__(self, folder, dim=128, compact_ratio=0.5):
+        self.folder = folder
+        self.dim = dim
+        self.compact_ratio = compact_ratio
+        self.index_path = os.path.join(folder, INDEX_NAME)
+
+    def _empty_index(self):
+        return {"dim": self.dim, "generation": 0, "data": "gallery-0.f32", "rows": 0, "employees": {}}
+
+    def read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return self._empty_index()
+
+    def stamp(self):
+        try:
+            st = os.stat(self.index_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns)
+
+    def _write_index(self, index):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        for attempt in range(50):
+            try:
+                os.replace(tmp, self.index_path)
+                return
+            except PermissionError:
+                # Windows refuses to replace a file a reader has open.
+                if attempt == 49:
+                    raise
+                time.sleep(0.01)
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, LOCK_NAME), "a+") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            else:
+                lock.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK gives up after ~10s; keep waiting.
+                        pass
+            try:
+                yield self.read_index()
+            finally:
+                if fcntl:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                else:
+                    lock.seek(0)
+                    msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def snapshot(self):
+        # Returns (index, matrix) where matrix is a read-only memmap over
+        # every row written to the current data file, live or not. A
+        # compaction can retire the data file between reading the index and
+        # mapping it; the index is re-read once in that case.
+        for attempt in range(2):
+            index = self.read_index()
+            rows = index["rows"]
+            if not rows:
+                return index, np.empty((0, self.dim), dtype=np.float32)
+            try:
+                matrix = np.memmap(
+                    os.path.join(self.folder, index["data"]),
+                    dtype=np.float32, mode="r", shape=(rows, index["dim"]),
+                )
+            except FileNotFoundError:
+                if attempt:
+                    raise
+                continue
+            return index, matrix
+
+    def load(self):
+        # Live rows only, plus the matching employee id for each row.
+        if not os.path.exists(self.index_path):
+            self.migrate_pickles(missing_only=True)
+        index, matrix = self.snapshot()
+        spans = sorted(
+            (e["offset"], e["count"], int(emp_id)) for emp_id, e in index["employees"].items() if e["count"]
+        )
+        if not spans:
+            return np.empty((0, self.dim), dtype=np.float32), np.empty(0, dtype=np.int64)
+        ids = np.concatenate([np.full(count, emp_id, dtype=np.int64) for _, count, emp_id in spans])
+        if len(ids) == index["rows"]:
+            return matrix, ids
+        return np.concatenate([matrix[off:off + count] for off, count, _ in spans]), ids
+
+    def get(self, employee_id):
+        index, matrix = self.snapshot()
+        entry = index["employees"].get(str(employee_id))
+        if not entry:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return np.array(matrix[entry["offset"]:entry["offset"] + entry["count"]])
+
+    def put(self, employee_id, embeddings, stamps=None):
+        return self.put_many({employee_id: embeddings}, stamps)[employee_id]
+
+    def put_many(self, items, stamps=None):
+        # One append and one index rewrite for a whole batch of employees.
+        # When given a list, stamps receives the index stamp from just before
+        # and just after this write, both taken under the lock.
+        items = {
+            employee_id: np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+            for employee_id, embeddings in items.items()
+        }
+        with self._locked() as index:
+            before = self.stamp()
+            versions = self._append(index, items)
+            self._write_index(index)
+            self._maybe_compact(index)
+            if stamps is not None:
+                stamps[:] = [before, self.stamp()]
+        return versions
+
+    def _append(self, index, items):
+        # Writes at the end recorded in the index, not the end of the file:
+        # bytes left over from a write that never reached the index (crash,
+        # full disk) are overwritten instead of shifting every later offset.
+        versions = {}
+        path = os.path.join(self.folder, index["data"])
+        with open(os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)), "r+b") as f:
+            f.seek(index["rows"] * self.dim * 4)
+            f.truncate()
+            for employee_id, rows in items.items():
+                key = str(employee_id)
+                version = index["employees"].get(key, {}).get("version", 0) + 1
+                f.write(rows.tobytes())
+                index["employees"][key] = {"offset": index["rows"], "count": len(rows), "version": version}
+                index["rows"] += len(rows)
+                versions[employee_id] = version
+            f.flush()
+            os.fsync(f.fileno())
+        return versions
+
+    def remove(self, employee_id, stamps=None):
+        with self._locked() as index:
+            before = self.stamp()
+            if index["employees"].pop(str(employee_id), None) is None:
+                if stamps is not None:
+                    stamps[:] = [before, before]
+                return False
+            self._write_index(index)
+            self._maybe_compact(index)
+            if stamps is not None:
+                stamps[:] = [before, self.stamp()]
+        return True
+
+    def compact(self):
+        with self._locked() as index:
+            self._compact(index)
+
+    def _maybe_compact(self, index):
+        live = sum(e["count"] for e in index["employees"].values())
+        if index["rows"] - live > self.compact_ratio * max(index["rows"], 1):
+            self._compact(index)
+
+    def _compact(self, index):
+        # The old data file stays on disk until the next compaction: readers
+        # may still have it mapped (Windows will not delete a mapped file)
+        # or be about to map it from the index they just read.
+        retired = [name for name in index.get("retired", []) if not self._delete(name)]
+        old_data = os.path.join(self.folder, index["data"])
+        generation = index["generation"] + 1
+        new_name = f"gallery-{generation}.f32"
+        new_path = os.path.join(self.folder, new_name)
+        matrix = None
+        if index["rows"]:
+            matrix = np.memmap(old_data, dtype=np.float32, mode="r", shape=(index["rows"], index["dim"]))
+        offset = 0
+        employees = {}
+        with open(new_path, "wb") as f:
+            for key, e in sorted(index["employees"].items(), key=lambda kv: kv[1]["offset"]):
+                if e["count"]:
+                    f.write(np.ascontiguousarray(matrix[e["offset"]:e["offset"] + e["count"]]).tobytes())
+                employees[key] = dict(e, offset=offset)
+                offset += e["count"]
+            f.flush()
+            os.fsync(f.fileno())
+        del matrix
+        if os.path.exists(old_data):
+            retired.append(index["data"])
+        index.update(generation=generation, data=new_name, rows=offset, employees=employees, retired=retired)
+        self._write_index(index)
+
+    def _delete(self, name):
+        try:
+            os.remove(os.path.join(self.folder, name))
+        except FileNotFoundError:
+            pass
+        except PermissionError:
+            return False
+        return True
+
+    def migrate_pickles(self, remove=False, missing_only=False):
+        # missing_only: first start after upgrading, import the legacy
+        # <id>_embeddings.pkl files unless another worker already did.
+        if not os.path.isdir(self.folder):
+            return 0
+        with self._locked() as index:
+            if missing_only and os.path.exists(self.index_path):
+                return 0
+            items, paths = {}, []
+            for name in sorted(os.listdir(self.folder)):
+                if not name.endswith("_embeddings.pkl"):
+                    continue
+                path = os.path.join(self.folder, name)
+                with open(path, "rb") as f:
+                    embeddings = pickle.load(f)
+                items[int(name.split("_", 1)[0])] = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+                paths.append(path)
+            if items:
+                self._append(index, items)
+                self._write_index(index)
+        if remove:
+            for path in paths:
+                os.remove(path)
+        return len(items)
+
+
+if __name__ == "__main__":
+    store = EmbeddingStore(EMBEDDINGS_FOLDER)
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "migrate":
+        n = store.migrate_pickles(remove="--remove-pickles" in sys.argv)
+        print(f"Migrated {n} pickle files into {store.index_path}")
+    elif command == "compact":
+        store.compact()
+        print(f"Compacted {store.index_path}")
+    else:
+        print("usage: python embedding_store.py migrate [--remove-pickles] | compact")
+        sys.exit(2)
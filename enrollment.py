@@ -0,0 +1,210 @@
+import os
+import time
+import uuid
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta
+import cv2
+import numpy as np
+import face_recognition
+from models import db, Employee, EnrollmentJob
+from recognition import scale_location
+from metrics import observe_stage, count
+
+log = logging.getLogger(__name__)
+
+
+def eye_aspect_ratio(eye):
+    A = np.linalg.norm(eye[1] - eye[5])
+    B = np.linalg.norm(eye[2] - eye[4])
+    C = np.linalg.norm(eye[0] - eye[3])
+    return (A + B) / (2.0 * C)
+
+
+def extract_faces(raw_path, out_folder, employee_id, ear_threshold=0.25, save_frames=True,
+                  sample_every=5, scale=0.5):
+    # Runs in a pool process: no app or database access in here. Each
+    # sampled frame is detected once on a downscaled copy; the chosen frames
+    # stay in memory and are encoded with those locations scaled back up, so
+    # dlib never has to find the face a second time.
+    if save_frames:
+        os.makedirs(out_folder, exist_ok=True)
+    loop_start = time.perf_counter()
+    vid = cv2.VideoCapture(raw_path)
+    frame_count = 0
+    consecutive_frames = 0
+    chosen = []
+    writer = ThreadPoolExecutor(max_workers=1) if save_frames else None
+
+    def keep(frame, location):
+        chosen.append((cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), scale_location(location, scale, frame.shape)))
+        if writer:
+            writer.submit(cv2.imwrite, os.path.join(out_folder, f"{employee_id}_{frame_count}.jpg"), frame)
+
+    while True:
+        if frame_count % sample_every != 0:
+            # grab() advances the stream without decoding the frame.
+            if not vid.grab():
+                break
+            frame_count += 1
+            continue
+        ret, frame = vid.read()
+        if not ret:
+            break
+        small = cv2.resize(frame, (0, 0), fx=scale, fy=scale)
+        rgb = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+        locations = face_recognition.face_locations(rgb)[:1]
+        landmarks_list = face_recognition.face_landmarks(rgb, face_locations=locations) if locations else []
+        if landmarks_list:
+            lm = landmarks_list[0]
+            if "left_eye" in lm and "right_eye" in lm:
+                left = np.array(lm["left_eye"])
+                right = np.array(lm["right_eye"])
+                ear = (eye_aspect_ratio(left) + eye_aspect_ratio(right)) / 2.0
+                if ear < ear_threshold:
+                    consecutive_frames += 1
+                else:
+                    if consecutive_frames >= 2:
+                        keep(frame, locations[0])
+                    consecutive_frames = 0
+            else:
+                if frame_count % 30 == 0:
+                    keep(frame, locations[0])
+        frame_count += 1
+
+    vid.release()
+    os.remove(raw_path)
+
+    encode_start = time.perf_counter()
+    embeddings = []
+    for rgb_full, location in chosen:
+        try:
+            encs = face_recognition.face_encodings(rgb_full, known_face_locations=[location])
+            if encs:
+                embeddings.append(encs[0])
+        except Exception:
+            pass
+    if writer:
+        writer.shutdown(wait=True)
+    timings = {
+        "enroll_frame_loop": encode_start - loop_start,
+        "enroll_encode": time.perf_counter() - encode_start,
+    }
+    return len(chosen), np.asarray(embeddings, dtype=np.float32).reshape(-1, 128), timings
+
+
+class EnrollmentQueue:
+    # One dispatcher thread per pool process: the thread marks its job
+    # running, hands the clip to the process pool and records the result, so
+    # job status in the database reflects what the pool is actually doing.
+
+    def __init__(self, app, gallery, workers, save_frames=True, heartbeat=30):
+        self.app = app
+        self.gallery = gallery
+        self.workers = workers
+        self.save_frames = save_frames
+        self.heartbeat = heartbeat
+        # Written on every job this process accepts; see _beat().
+        self.owner = str(uuid.uuid4())
+        self._lock = threading.Lock()
+        self._threads = None
+        self._processes = None
+
+    def _pools(self):
+        with self._lock:
+            if self._processes is None:
+                self._processes = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+                self._threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="enroll")
+                threading.Thread(target=self._beat, name="enroll-heartbeat", daemon=True).start()
+        return self._threads, self._processes
+
+    def _beat(self):
+        # Keeps this process's unfinished jobs fresh, including those still
+        # waiting for a pool thread, so fail_stale() only catches jobs whose
+        # owning process has died or been recycled.
+        while True:
+            time.sleep(self.heartbeat)
+            try:
+                with self.app.app_context():
+                    db.session.execute(
+                        db.update(EnrollmentJob)
+                        .where(EnrollmentJob.owner == self.owner,
+                               EnrollmentJob.status.in_(["queued", "running"]))
+                        .values(updated_at=datetime.utcnow())
+                    )
+                    db.session.commit()
+            except Exception:
+                log.warning("Enrollment heartbeat failed", exc_info=True)
+
+    def submit(self, job_id, employee_id, raw_path, out_folder):
+        threads, _ = self._pools()
+        return threads.submit(self._run, job_id, employee_id, raw_path, out_folder)
+
+    def fail_stale(self, max_age):
+        # Jobs live only in their process's memory. A queued/running job
+        # whose owner stopped refreshing it for max_age seconds was lost to
+        # a restart; fail it and delete its clip from the public raw folder.
+        # Call inside an app context.
+        cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+        stale = EnrollmentJob.query.filter(
+            EnrollmentJob.status.in_(["queued", "running"]),
+            EnrollmentJob.updated_at <= cutoff,
+            db.or_(EnrollmentJob.owner.is_(None), EnrollmentJob.owner != self.owner),
+        ).all()
+        for job in stale:
+            job.status = "failed"
+            job.error = "Enrollment was interrupted by a server restart; please capture again"
+            job.updated_at = datetime.utcnow()
+            if job.raw_path and os.path.exists(job.raw_path):
+                os.remove(job.raw_path)
+        db.session.commit()
+        return len(stale)
+
+    def _update(self, job_id, **fields):
+        job = db.session.get(EnrollmentJob, job_id)
+        if job is None:
+            return None
+        for k, v in fields.items():
+            setattr(job, k, v)
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+        return job
+
+    def _run(self, job_id, employee_id, raw_path, out_folder):
+        _, processes = self._pools()
+        with self.app.app_context():
+            job = db.session.get(EnrollmentJob, job_id)
+            if job is None or job.status == "failed":
+                # Given up on (fail_stale) while it waited for a thread.
+                if os.path.exists(raw_path):
+                    os.remove(raw_path)
+                return
+            self._update(job_id, status="running")
+            try:
+                image_count, embeddings, timings = processes.submit(
+                    extract_faces, raw_path, out_folder, employee_id, save_frames=self.save_frames
+                ).result()
+                for name, seconds in timings.items():
+                    observe_stage(name, seconds)
+                emp = db.session.get(Employee, employee_id)
+                if emp is None:
+                    self._update(job_id, status="failed", error="Employee was deleted during enrollment")
+                    count("attendance_enrollments_total", status="failed")
+                    return
+                self.gallery.add(employee_id, embeddings)
+                emp.face_data_folder = out_folder
+                self._update(
+                    job_id, status="done",
+                    image_count=image_count, embedding_count=len(embeddings),
+                )
+                count("attendance_enrollments_total", status="done")
+            except Exception as e:
+                db.session.rollback()
+                if os.path.exists(raw_path):
+                    os.remove(raw_path)
+                self._update(job_id, status="failed", error=str(e)[:500])
+                count("attendance_enrollments_total", status="failed")
@@ -1,18 +1,190 @@
-import os, pickle
+import os
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import face_recognition
-from models import Employee
-from app import app
-
-with app.app_context():
-    for emp in Employee.query.all():
-        folder = os.path.join('static','captures',str(emp.id))
-        if not os.path.isdir(folder): continue
-        embeddings=[]
-        for f in os.listdir(folder):
-            img=face_recognition.load_image_file(os.path.join(folder,f))
-            e=face_recognition.face_encodings(img)
-            if e: embeddings.append(e[0])
-        os.makedirs('static/embeddings', exist_ok=True)
-        with open(f'static/embeddings/{emp.id}_embeddings.pkl','wb') as out:
-            pickle.dump(embeddings,out)
-        print(f"Saved {len(embeddings)} embeddings for {emp.name}")
+
+CAPTURES_FOLDER = os.path.join('static', 'captures')
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def encode_image(emp_id, name, path):
+    start = time.perf_counter()
+    e = face_recognition.face_encodings(face_recognition.load_image_file(path))
+    encoding = [float(v) for v in e[0]] if e else None
+    return emp_id, name, encoding, time.perf_counter() - start
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'employees': {}}
+
+
+def save_manifest(path, manifest):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+
+
+def plan(employees, manifest, full):
+    # Decide per image whether its cached encoding can be reused. Size and
+    # mtime are checked first; the content hash only when they differ, so a
+    # restore from backup with new mtimes does not force a re-encode.
+    work = {}
+    for emp in employees:
+        folder = os.path.join(CAPTURES_FOLDER, str(emp.id))
+        if not os.path.isdir(folder):
+            continue
+        cached = manifest['employees'].get(str(emp.id), {}).get('images', {})
+        images, stale = {}, []
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            st = os.stat(path)
+            entry = cached.get(name)
+            if entry and not full:
+                if entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+                    images[name] = entry
+                    continue
+                digest = file_digest(path)
+                if digest == entry['sha1']:
+                    images[name] = dict(entry, size=st.st_size, mtime_ns=st.st_mtime_ns)
+                    continue
+            else:
+                digest = file_digest(path)
+            # No 'encoding' key until encoded; None means no face was found.
+            images[name] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': digest}
+            stale.append(name)
+        removed = set(cached) - set(images)
+        work[emp.id] = (emp, folder, images, stale, bool(removed))
+    return work
+
+
+def finish(pending, emp, images, reencoded, seconds, position, total):
+    embeddings = [e['encoding'] for e in images.values() if e['encoding'] is not None]
+    pending[emp.id] = (np.asarray(embeddings, dtype=np.float32).reshape(-1, 128), images)
+    print(f"[{position}/{total}] {emp.name}: {len(images)} images, {reencoded} re-encoded, "
+          f"{len(embeddings)} embeddings ({seconds:.2f}s encode time)")
+
+
+def flush(store, manifest, pending):
+    # One store write (data append, index rewrite, fsync) per batch of
+    # employees instead of one per employee.
+    if not pending:
+        return
+    versions = store.put_many({emp_id: rows for emp_id, (rows, _) in pending.items()})
+    for emp_id, (_, images) in pending.items():
+        manifest['employees'][str(emp_id)] = {'version': versions[emp_id], 'images': images}
+    pending.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the face gallery from static/captures.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--full', action='store_true', help='re-encode every image, e.g. after a model upgrade')
+    parser.add_argument('--dry-run', action='store_true', help='report what would be rebuilt and exit')
+    parser.add_argument('--employee', type=int, action='append', help='limit to these employee ids')
+    parser.add_argument('--batch-size', type=int, default=200, help='employees per gallery write')
+    args = parser.parse_args()
+
+    from app import app, store
+    from models import Employee
+
+    manifest_path = os.path.join(store.folder, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    indexed = store.read_index()['employees']
+
+    def out_of_date(emp_id, w):
+        # Enrolling through /capture bumps the store version, so a mismatch
+        # means the gallery no longer reflects what is in static/captures.
+        built = manifest['employees'].get(str(emp_id), {}).get('version')
+        return w[3] or w[4] or built is None or built != indexed.get(str(emp_id), {}).get('version')
+
+    with app.app_context():
+        q = Employee.query
+        if args.employee:
+            q = q.filter(Employee.id.in_(args.employee))
+        work = plan(q.order_by(Employee.id).all(), manifest, args.full)
+
+    # Never let the captures folder overwrite a gallery entry it cannot
+    # reproduce: an empty folder (ENROLL_SAVE_FRAMES off) would wipe the
+    # employee's embeddings, and unchanged older frames after a /capture
+    # enrollment would put back the previous face.
+    skipped = {}
+    for emp_id, w in work.items():
+        entry = manifest['employees'].get(str(emp_id), {})
+        stored = indexed.get(str(emp_id), {}).get('version')
+        if not w[2]:
+            if out_of_date(emp_id, w):
+                skipped[emp_id] = 'no images in its captures folder, gallery entry kept'
+        elif not (args.full or w[3] or w[4]) and entry.get('version') not in (None, stored) and stored:
+            skipped[emp_id] = 're-enrolled without saved frames, gallery entry is newer than its captures'
+            if not args.dry_run:
+                entry['version'] = stored
+    todo = {emp_id: w for emp_id, w in work.items() if emp_id not in skipped and out_of_date(emp_id, w)}
+    n_images = sum(len(w[3]) for w in todo.values())
+    print(f"{len(work)} employees with captures, {len(todo)} to rebuild, {n_images} images to encode")
+    for emp_id, reason in skipped.items():
+        print(f"  skipped {emp_id} {work[emp_id][0].name}: {reason}")
+    if args.dry_run:
+        for emp, _, images, stale, removed in todo.values():
+            print(f"  {emp.id} {emp.name}: {len(stale)} new/changed of {len(images)} images"
+                  + (", images removed" if removed else ""))
+        return
+
+    started = time.perf_counter()
+    done = 0
+    remaining = {emp_id: len(w[3]) for emp_id, w in todo.items()}
+    seconds = dict.fromkeys(todo, 0.0)
+    pending = {}
+    try:
+        for emp_id, (emp, _, images, stale, _) in todo.items():
+            if not stale:
+                done += 1
+                finish(pending, emp, images, 0, 0.0, done, len(todo))
+                if len(pending) >= args.batch_size:
+                    flush(store, manifest, pending)
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = [
+                pool.submit(encode_image, emp_id, name, os.path.join(w[1], name))
+                for emp_id, w in todo.items() for name in w[3]
+            ]
+            for future in as_completed(futures):
+                emp_id, name, encoding, elapsed = future.result()
+                emp, _, images, stale, _ = todo[emp_id]
+                images[name]['encoding'] = encoding
+                seconds[emp_id] += elapsed
+                remaining[emp_id] -= 1
+                if remaining[emp_id] == 0:
+                    done += 1
+                    finish(pending, emp, images, len(stale), seconds[emp_id], done, len(todo))
+                    if len(pending) >= args.batch_size:
+                        flush(store, manifest, pending)
+    finally:
+        flush(store, manifest, pending)
+        # Keep finished encodings of an interrupted run; the employee's
+        # store version stays behind, so the next run picks it up again.
+        for emp_id, w in todo.items():
+            if remaining[emp_id]:
+                entry = manifest['employees'].setdefault(str(emp_id), {})
+                entry['images'] = {name: e for name, e in w[2].items() if 'encoding' in e}
+        save_manifest(manifest_path, manifest)
+    print(f"Rebuilt {done} employees in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
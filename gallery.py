@@ -0,0 +1,115 @@
+import threading
+from collections import namedtuple
+import numpy as np
+
+Match = namedtuple("Match", ["employee_id", "distance", "margin"])
+
+
+class FaceGallery:
+    # Every enrolled embedding lives in one float32 matrix; row i belongs to
+    # employee ids[i]. Updates build new arrays and swap them in, so readers
+    # never take the lock.
+
+    def __init__(self, store):
+        self.store = store
+        self.dim = store.dim
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._loaded = False
+        self._set(np.empty((0, self.dim), dtype=np.float32), np.empty(0, dtype=np.int64))
+
+    def __len__(self):
+        return len(self._state[1])
+
+    def _set(self, matrix, ids):
+        # A store with no dead rows hands back its memmap as-is, so workers
+        # share the matrix through the page cache instead of copying it.
+        matrix = np.asarray(matrix, dtype=np.float32)
+        sq_norms = np.einsum("ij,ij->i", matrix, matrix)
+        self._state = (matrix, ids, sq_norms)
+
+    def load(self):
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        stamp = self.store.stamp()
+        self._set(*self.store.load())
+        self._stamp = stamp
+        self._loaded = True
+
+    def ensure_fresh(self):
+        # Other workers enroll and delete too; the index file stamp tells us
+        # when our copy is stale.
+        if not self._loaded or self.store.stamp() != self._stamp:
+            self.load()
+
+    def _adopt(self, stamps):
+        # Patching in place is only safe if nobody else wrote to the store
+        # since our last load; otherwise their change would be hidden behind
+        # the new stamp, so reload everything.
+        if stamps[0] != self._stamp:
+            self._load()
+            return False
+        self._stamp = stamps[1]
+        return True
+
+    def add(self, employee_id, embeddings):
+        # Writes through to the store, then updates the in-memory matrix.
+        rows = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock:
+            stamps = []
+            version = self.store.put(employee_id, rows, stamps)
+            if self._adopt(stamps):
+                matrix, ids, _ = self._state
+                keep = ids != employee_id
+                self._set(
+                    np.vstack([matrix[keep], rows]),
+                    np.concatenate([ids[keep], np.full(len(rows), employee_id, dtype=np.int64)]),
+                )
+        return version
+
+    def remove(self, employee_id):
+        with self._lock:
+            stamps = []
+            removed = self.store.remove(employee_id, stamps)
+            if self._adopt(stamps):
+                matrix, ids, _ = self._state
+                keep = ids != employee_id
+                self._set(matrix[keep], ids[keep])
+        return removed
+
+    def match(self, encoding, tolerance=0.6, min_margin=0.0):
+        matrix, ids, sq_norms = self._state
+        if not len(ids):
+            return None
+        q = np.asarray(encoding, dtype=np.float32)
+        d2 = sq_norms - 2.0 * (matrix @ q) + q @ q
+        dist = np.sqrt(np.maximum(d2, 0.0))
+        best = int(np.argmin(dist))
+        emp_id = int(ids[best])
+        others = dist[ids != emp_id]
+        runner_up = float(others.min()) if others.size else float("inf")
+        result = Match(emp_id, float(dist[best]), runner_up - float(dist[best]))
+        if result.distance > tolerance or result.margin < min_margin:
+            return None
+        return result
+
+    def match_many(self, encodings, tolerance=0.6, min_margin=0.0):
+        # One (faces x rows) distance matrix for a whole group frame instead
+        # of a matvec per face. Returns a Match or None per encoding.
+        matrix, ids, sq_norms = self._state
+        q = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        if not len(ids) or not len(q):
+            return [None] * len(q)
+        d2 = sq_norms[None, :] - 2.0 * (q @ matrix.T) + np.einsum("ij,ij->i", q, q)[:, None]
+        dist = np.sqrt(np.maximum(d2, 0.0))
+        best = np.argmin(dist, axis=1)
+        best_dist = dist[np.arange(len(q)), best]
+        best_ids = ids[best]
+        runner_up = np.where(ids[None, :] == best_ids[:, None], np.inf, dist).min(axis=1)
+        results = []
+        for emp_id, d, r in zip(best_ids, best_dist, runner_up):
+            result = Match(int(emp_id), float(d), float(r) - float(d))
+            results.append(None if result.distance > tolerance or result.margin < min_margin else result)
+        return results
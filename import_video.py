@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from collections import defaultdict
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import cv2
+from config import Config
+
+MATCH_BATCH = 256
+
+# Usage:
+#   python import_video.py entrance.mp4 --start "2024-06-03 07:45:00" --dry-run
+#   python import_video.py entrance.mp4 --start "2024-06-03 07:45:00"
+# The video is cut into frame ranges scanned in parallel; workers only detect
+# and encode, matching and tracking happen here against one gallery copy.
+
+
+def video_info(path):
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        return 0, 0.0
+    frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    cap.release()
+    return frames, fps
+
+
+def scan_range(path, first, last, every, scale, max_faces):
+    # grab() skips frames without decoding them; only every n-th frame (on a
+    # grid shared by all ranges) is decoded and run through detection.
+    from recognition import encode_all
+    cap = cv2.VideoCapture(path)
+    if first:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+    hits = []
+    index = first
+    while index < last:
+        if index % every:
+            if not cap.grab():
+                break
+        else:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            faces = encode_all(frame, scale=scale, max_faces=max_faces)
+            if faces:
+                hits.append((index, np.asarray([enc for _, enc, _ in faces], dtype=np.float32)))
+        index += 1
+    cap.release()
+    return first, index - first, hits
+
+
+def find_tracks(sightings, gap, min_hits):
+    # Sightings of one employee closer than `gap` seconds form a track; a
+    # track needs `min_hits` sightings so a single false match is ignored.
+    for emp_id, times in sightings.items():
+        times = sorted(times)
+        run = [times[0]]
+        for t in times[1:] + [None]:
+            if t is not None and t - run[-1] <= gap:
+                run.append(t)
+                continue
+            if len(run) >= min_hits:
+                yield emp_id, run[0], run[-1], len(run)
+            run = [t]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mark attendance from recorded entrance footage.")
+    parser.add_argument("video")
+    parser.add_argument("--start", help="UTC wall-clock time of the first frame, e.g. '2024-06-03 07:45:00' "
+                                        "(default: file modification time minus the video length)")
+    parser.add_argument("--sample-every", type=float, default=0.5, help="seconds between analysed frames")
+    parser.add_argument("--chunk-seconds", type=float, default=60.0, help="length of each worker's frame range")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--scale", type=float, default=Config.RECOGNITION_SCALE)
+    parser.add_argument("--max-faces", type=int, default=Config.GROUP_MAX_FACES)
+    parser.add_argument("--tolerance", type=float, default=Config.FACE_MATCH_TOLERANCE)
+    parser.add_argument("--margin", type=float, default=Config.FACE_MATCH_MARGIN)
+    parser.add_argument("--gap", type=float, default=30.0, help="seconds without a sighting that end a track")
+    parser.add_argument("--min-hits", type=int, default=3, help="sightings needed before a track counts")
+    parser.add_argument("--dry-run", action="store_true", help="report the tracks found without writing")
+    args = parser.parse_args()
+
+    frames, fps = video_info(args.video)
+    if not frames:
+        print(f"Cannot read {args.video}", file=sys.stderr)
+        sys.exit(1)
+    if args.start:
+        start = datetime.fromisoformat(args.start)
+    else:
+        start = datetime.utcfromtimestamp(os.path.getmtime(args.video)) - timedelta(seconds=frames / fps)
+    every = max(1, int(round(args.sample_every * fps)))
+    chunk = max(every, int(args.chunk_seconds * fps) // every * every)
+    ranges = [(first, min(first + chunk, frames)) for first in range(0, frames, chunk)]
+    print(f"{frames} frames at {fps:.1f} fps, analysing every {every}th frame in {len(ranges)} ranges")
+
+    from app import app, gallery
+    from models import db, Employee
+    from attendance import mark_attendance
+
+    with app.app_context():
+        gallery.ensure_fresh()
+    sightings = defaultdict(list)
+    scanned = analysed = faces = 0
+    began = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [
+            pool.submit(scan_range, args.video, first, last, every, args.scale, args.max_faces)
+            for first, last in ranges
+        ]
+        for future in as_completed(futures):
+            first, n, hits = future.result()
+            scanned += n
+            analysed += len(range(-first % every, n, every))
+            if not hits:
+                continue
+            encodings = np.concatenate([encs for _, encs in hits])
+            frame_of = np.concatenate([np.full(len(encs), index) for index, encs in hits])
+            faces += len(encodings)
+            # match_many builds a faces x gallery-rows matrix; bound it.
+            for lo in range(0, len(encodings), MATCH_BATCH):
+                matches = gallery.match_many(encodings[lo:lo + MATCH_BATCH], args.tolerance, args.margin)
+                for index, m in zip(frame_of[lo:lo + MATCH_BATCH], matches):
+                    if m:
+                        sightings[m.employee_id].append(float(index) / fps)
+            print(f"  frames {first}-{first + n}: {len(hits)} frames with faces", file=sys.stderr)
+    elapsed = time.perf_counter() - began
+    print(f"Scanned {scanned} frames ({analysed} analysed, {faces} faces) in {elapsed:.1f}s")
+
+    tracks = sorted(find_tracks(sightings, args.gap, args.min_hits), key=lambda t: t[1])
+    with app.app_context():
+        employees = {e.id: e for e in Employee.query.filter(Employee.id.in_([t[0] for t in tracks])).all()}
+        marked = 0
+        for emp_id, first_seen, last_seen, hits in tracks:
+            emp = employees.get(emp_id)
+            if emp is None:
+                continue
+            when = start + timedelta(seconds=first_seen)
+            if args.dry_run:
+                status = "would mark"
+            elif mark_attendance(emp, when, digest=app.config["MAIL_DIGEST"]):
+                status = "marked"
+                marked += 1
+            else:
+                status = "already marked"
+            print(f"  {emp.id} {emp.name}: {when:%Y-%m-%d %H:%M:%S} "
+                  f"({hits} sightings over {last_seen - first_seen:.0f}s) {status}")
+        if not args.dry_run:
+            db.session.commit()
+    print(f"{len(tracks)} tracks, {len(employees)} employees" +
+          ("" if args.dry_run else f", {marked} attendance records written"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+import numpy as np
+
+# Simulates a shift start: many kiosks marking the same employees at once.
+# Every thread tries to mark every employee; exactly one row per employee
+# per day must survive, with no "database is locked" errors.
+
+
+def worker(app, employee_ids, rounds, barrier, latencies, errors, seed):
+    from sqlalchemy.exc import OperationalError
+    from models import db, Employee
+    from attendance import mark_attendance
+    rng = random.Random(seed)
+    with app.app_context():
+        barrier.wait()
+        for _ in range(rounds):
+            order = list(employee_ids)
+            rng.shuffle(order)
+            for emp_id in order:
+                start = time.perf_counter()
+                try:
+                    emp = db.session.get(Employee, emp_id)
+                    if mark_attendance(emp, datetime.utcnow()):
+                        db.session.commit()
+                    else:
+                        db.session.rollback()
+                except OperationalError as e:
+                    db.session.rollback()
+                    errors.append(str(e.orig))
+                latencies.append(time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent attendance marking load test.")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--employees", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=2)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="attendance-load-")
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(workdir, "load.db")
+    os.environ["EMBEDDINGS_FOLDER"] = os.path.join(workdir, "embeddings")
+    try:
+        from app import app
+        from models import db, Employee, Attendance, OutboxMessage, DailyAttendance, upgrade_schema
+        with app.app_context():
+            db.create_all()
+            upgrade_schema()
+            db.session.execute(db.insert(Employee), [
+                {"id": i, "name": f"Employee {i}", "department": f"Dept {i % 7}",
+                 "email": f"employee{i}@example.com", "contact": "0000000000"}
+                for i in range(1, args.employees + 1)
+            ])
+            db.session.commit()
+            journal_mode = db.session.execute(db.text("PRAGMA journal_mode")).scalar()
+
+        employee_ids = range(1, args.employees + 1)
+        barrier = threading.Barrier(args.threads)
+        latencies, errors = [], []
+        threads = [
+            threading.Thread(target=worker, args=(app, employee_ids, args.rounds, barrier, latencies, errors, i))
+            for i in range(args.threads)
+        ]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        with app.app_context():
+            rows = db.session.scalar(db.select(db.func.count()).select_from(Attendance))
+            duplicates = db.session.execute(
+                db.select(Attendance.employee_id, Attendance.day, db.func.count())
+                .group_by(Attendance.employee_id, Attendance.day)
+                .having(db.func.count() > 1)
+            ).all()
+            outbox = db.session.scalar(db.select(db.func.count()).select_from(OutboxMessage))
+            rollups = db.session.scalar(db.select(db.func.count()).select_from(DailyAttendance))
+
+        ms = np.asarray(latencies) * 1000.0
+        report = {
+            "journal_mode": journal_mode,
+            "threads": args.threads,
+            "attempts": len(latencies),
+            "seconds": round(elapsed, 3),
+            "attempts_per_s": round(len(latencies) / elapsed, 1),
+            "latency_ms": {
+                "p50": round(float(np.percentile(ms, 50)), 2),
+                "p95": round(float(np.percentile(ms, 95)), 2),
+                "p99": round(float(np.percentile(ms, 99)), 2),
+                "max": round(float(ms.max()), 2),
+            },
+            "attendance_rows": rows,
+            "outbox_rows": outbox,
+            "rollup_rows": rollups,
+            "duplicates": len(duplicates),
+            "errors": len(errors),
+        }
+        print(json.dumps(report, indent=2))
+        ok = not errors and not duplicates and rows == outbox == rollups == args.employees
+        if errors:
+            print(f"First error: {errors[0]}", file=sys.stderr)
+        print("PASS" if ok else "FAIL", file=sys.stderr)
+        sys.exit(0 if ok else 1)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import smtplib
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+from flask_mail import Message
+from models import db, OutboxMessage
+
+log = logging.getLogger(__name__)
+
+
+def enqueue(recipient, subject, body, digest=False):
+    # Only adds to the session: the message commits (or rolls back) together
+    # with whatever the caller is writing.
+    now = datetime.utcnow()
+    msg = OutboxMessage(
+        recipient=recipient,
+        subject=subject,
+        body=body,
+        digest_day=now.date() if digest else None,
+        created_at=now,
+        next_attempt_at=now,
+        attempts=0,
+        failed=False,
+    )
+    db.session.add(msg)
+    return msg
+
+
+class OutboxSender:
+    # Drains the outbox over one SMTP connection per batch. Rows are claimed
+    # by pushing next_attempt_at out by a lease before sending, so a second
+    # sender (or a crashed one) cannot deliver the same row twice.
+
+    def __init__(self, app, mail):
+        self.app = app
+        self.mail = mail
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def config(self):
+        return self.app.config
+
+    def _claim(self, rows, now):
+        lease = now + timedelta(seconds=self.config["MAIL_OUTBOX_LEASE"])
+        claimed = []
+        for row in rows:
+            result = db.session.execute(
+                db.update(OutboxMessage)
+                .where(OutboxMessage.id == row.id, OutboxMessage.next_attempt_at == row.next_attempt_at)
+                .values(next_attempt_at=lease)
+            )
+            if result.rowcount:
+                claimed.append(row)
+        db.session.commit()
+        return claimed
+
+    def _due(self, now):
+        pending = OutboxMessage.query.filter(
+            OutboxMessage.sent_at.is_(None),
+            OutboxMessage.failed.is_(False),
+            OutboxMessage.next_attempt_at <= now,
+        )
+        immediate = (
+            pending.filter(OutboxMessage.digest_day.is_(None))
+            .order_by(OutboxMessage.id)
+            .limit(self.config["MAIL_OUTBOX_BATCH_SIZE"])
+            .all()
+        )
+        # A digest goes out once its day is over, with every message for
+        # that recipient and day in one email.
+        digests = (
+            pending.filter(OutboxMessage.digest_day < now.date())
+            .order_by(OutboxMessage.id)
+            .all()
+        )
+        return immediate, digests
+
+    def _groups(self, immediate, digests):
+        groups = [[row] for row in immediate]
+        by_key = {}
+        for row in digests:
+            by_key.setdefault((row.recipient, row.digest_day), []).append(row)
+        groups.extend(by_key.values())
+        return groups
+
+    def _message(self, rows):
+        first = rows[0]
+        msg = Message(
+            first.subject if first.digest_day is None else f"Attendance Digest for {first.digest_day}",
+            sender=self.config["MAIL_USERNAME"],
+            recipients=[first.recipient],
+        )
+        msg.body = "\n\n".join(r.body for r in rows)
+        return msg
+
+    def _retry(self, rows, error, now):
+        for row in rows:
+            row.attempts += 1
+            row.last_error = str(error)[:500]
+            if row.attempts >= self.config["MAIL_OUTBOX_MAX_ATTEMPTS"]:
+                row.failed = True
+                log.error("Giving up on outbox message %s to %s: %s", row.id, row.recipient, error)
+            else:
+                delay = min(self.config["MAIL_OUTBOX_BACKOFF"] * 2 ** (row.attempts - 1), 3600)
+                row.next_attempt_at = now + timedelta(seconds=delay)
+
+    def drain(self):
+        now = datetime.utcnow()
+        immediate, digests = self._due(now)
+        rows = self._claim(immediate + digests, now)
+        if not rows:
+            return 0
+        claimed = {row.id for row in rows}
+        groups = [g for g in self._groups(immediate, digests) if all(r.id in claimed for r in g)]
+        sent = 0
+        dropped = False
+        try:
+            with self.mail.connect() as conn:
+                for group in groups:
+                    try:
+                        conn.send(self._message(group))
+                    except smtplib.SMTPServerDisconnected as e:
+                        # The connection is gone, so every later send would
+                        # fail too. The group in flight spends an attempt (a
+                        # message that always makes the server hang up must
+                        # still end up failed); later groups keep their lease
+                        # and are picked up again once it expires.
+                        log.warning("SMTP connection dropped after %d messages: %s", sent, e)
+                        self._retry(group, e, now)
+                        dropped = True
+                        break
+                    except Exception as e:
+                        self._retry(group, e, now)
+                        continue
+                    for row in group:
+                        row.sent_at = datetime.utcnow()
+                    sent += len(group)
+        except smtplib.SMTPServerDisconnected as e:
+            # QUIT on the dropped connection fails as well.
+            if not dropped:
+                self._retry([r for g in groups for r in g if r.sent_at is None], e, now)
+        except Exception as e:
+            # Connecting (or QUIT) failed: anything not marked sent retries.
+            self._retry([r for g in groups for r in g if r.sent_at is None], e, now)
+        db.session.commit()
+        return sent
+
+    def run(self, interval=None):
+        interval = interval or self.config["MAIL_OUTBOX_INTERVAL"]
+        while not self._stop.is_set():
+            with self.app.app_context():
+                try:
+                    while self.drain():
+                        pass
+                except Exception:
+                    db.session.rollback()
+                    log.exception("Outbox drain failed")
+            self._stop.wait(interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="outbox-sender", daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deliver queued attendance emails.")
+    parser.add_argument("--once", action="store_true", help="drain the outbox once and exit")
+    parser.add_argument("--smtp", help="host:port of a plain SMTP server to use instead of MAIL_SERVER, "
+                                       "e.g. a local 'python -m aiosmtpd -n -l localhost:8025'")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from app import app, mail
+    if args.smtp:
+        host, port = args.smtp.rsplit(":", 1)
+        app.config.update(MAIL_SERVER=host, MAIL_PORT=int(port), MAIL_USE_TLS=False,
+                          MAIL_USE_SSL=False, MAIL_PASSWORD=None)
+        mail.state = mail.init_app(app)
+    sender = OutboxSender(app, mail)
+    if args.once:
+        with app.app_context():
+            total = 0
+            while True:
+                n = sender.drain()
+                if not n:
+                    break
+                total += n
+        print(f"Sent {total} messages")
+    else:
+        try:
+            sender.run()
+        except KeyboardInterrupt:
+            pass
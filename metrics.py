@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import g, has_request_context, request, Response
+
+log = logging.getLogger(__name__)
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels(labels, extra=None):
+    items = sorted(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Registry:
+    # Process-local. Gunicorn workers share one host:port, so a scrape lands
+    # on a random worker; set METRICS_DIR to have every worker dump its
+    # numbers there and /metrics serve the sum over all of them.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [[0] * (len(STAGE_BUCKETS) + 1), 0.0, 0]
+            h[0][bisect_left(STAGE_BUCKETS, value)] += 1
+            h[1] += value
+            h[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return (
+                [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                [[name, list(labels), list(h[0]), h[1], h[2]] for (name, labels), h in self._histograms.items()],
+            )
+
+    def dump(self, folder):
+        # One file per process, replaced atomically; files of exited workers
+        # stay so their counts keep contributing, like counters should.
+        counters, histograms = self.snapshot()
+        path = os.path.join(folder, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({"counters": counters, "histograms": histograms}, f)
+        os.replace(path + ".tmp", path)
+
+    def render(self, folder=None):
+        if folder is None:
+            counters, histograms = self.snapshot()
+        else:
+            self.dump(folder)
+            counters, histograms = [], []
+            for name in os.listdir(folder):
+                if name.endswith(".json"):
+                    try:
+                        with open(os.path.join(folder, name)) as f:
+                            data = json.load(f)
+                    except (OSError, ValueError):
+                        continue
+                    counters += data["counters"]
+                    histograms += data["histograms"]
+        merged_counters, merged_histograms = {}, {}
+        for name, labels, value in counters:
+            key = (name, tuple(tuple(l) for l in labels))
+            merged_counters[key] = merged_counters.get(key, 0) + value
+        for name, labels, buckets, total, n in histograms:
+            key = (name, tuple(tuple(l) for l in labels))
+            h = merged_histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            h[0] = [a + b for a, b in zip(h[0], buckets)]
+            h[1] += total
+            h[2] += n
+        counters = sorted(merged_counters.items())
+        histograms = sorted(merged_histograms.items())
+        lines, described = [], set()
+
+        def header(name, default_kind):
+            if name not in described:
+                kind, text = self._help.get(name, (default_kind, name))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, n in zip(STAGE_BUCKETS + (float("inf"),), buckets):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_labels(labels, ('le', le))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+registry.describe("attendance_stage_seconds", "histogram", "Time spent per pipeline stage.")
+registry.describe("attendance_request_seconds", "histogram", "Request latency by endpoint.")
+registry.describe("attendance_recognitions_total", "counter", "Recognition attempts by result.")
+registry.describe("attendance_enrollments_total", "counter", "Finished enrollment jobs by status.")
+
+
+def observe_stage(name, seconds):
+    registry.observe("attendance_stage_seconds", seconds, stage=name)
+    if has_request_context() and "stages" in g:
+        g.stages[name] = g.stages.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def count(name, **labels):
+    registry.inc(name, **labels)
+
+
+def init_app(app):
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.stages = {}
+
+    folder = app.config["METRICS_DIR"]
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    @app.after_request
+    def record_request(response):
+        if "request_start" not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_start
+        registry.observe("attendance_request_seconds", elapsed, endpoint=request.endpoint or "unknown")
+        if folder:
+            registry.dump(folder)
+        if elapsed >= app.config["SLOW_REQUEST_SECONDS"]:
+            breakdown = ", ".join(f"{k}={v * 1000:.1f}ms" for k, v in g.stages.items())
+            log.warning("Slow request %s %s took %.1fms (%s)", request.method, request.path,
+                        elapsed * 1000, breakdown or "no stages")
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(registry.render(folder), mimetype="text/plain; version=0.0.4")
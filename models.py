@@ -1,3 +1,4 @@
+from datetime import datetime, time, timedelta
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 
@@ -23,8 +24,135 @@ class Employee(db.Model):
         cascade='all, delete-orphan',
         passive_deletes=True
     )
+    enrollment_jobs = db.relationship(
+        'EnrollmentJob',
+        backref='employee',
+        lazy=True,
+        cascade='all, delete-orphan',
+        passive_deletes=True
+    )
+    daily_attendance = db.relationship(
+        'DailyAttendance',
+        backref='employee',
+        lazy=True,
+        cascade='all, delete-orphan',
+        passive_deletes=True
+    )
+
+def _attendance_day(context):
+    return context.get_current_parameters()['timestamp'].date()
 
 class Attendance(db.Model):
+    __table_args__ = (
+        db.Index('ix_attendance_employee_timestamp', 'employee_id', 'timestamp'),
+        db.Index('ix_attendance_timestamp_id', 'timestamp', 'id'),
+        db.Index('uq_attendance_employee_day', 'employee_id', 'day', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     employee_id = db.Column(db.Integer, db.ForeignKey('employee.id', ondelete='CASCADE'), nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False)
+    # Calendar day of timestamp; backs the one-punch-per-day constraint.
+    day = db.Column(db.Date, nullable=False, default=_attendance_day)
+
+class EnrollmentJob(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    employee_id = db.Column(db.Integer, db.ForeignKey('employee.id', ondelete='CASCADE'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    image_count = db.Column(db.Integer, nullable=False, default=0)
+    embedding_count = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    # EnrollmentQueue.owner of the process holding the job; it refreshes
+    # updated_at while alive, so a stale row means that process is gone.
+    owner = db.Column(db.String(36))
+    raw_path = db.Column(db.String(300))
+
+class OutboxMessage(db.Model):
+    __table_args__ = (
+        db.Index('ix_outbox_pending', 'sent_at', 'next_attempt_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(150), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    digest_day = db.Column(db.Date)
+    created_at = db.Column(db.DateTime, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    sent_at = db.Column(db.DateTime)
+    failed = db.Column(db.Boolean, nullable=False, default=False)
+    last_error = db.Column(db.String(500))
+
+class DailyAttendance(db.Model):
+    # One row per employee per day, maintained at mark time by rollups.py.
+    day = db.Column(db.Date, primary_key=True)
+    employee_id = db.Column(db.Integer, db.ForeignKey('employee.id', ondelete='CASCADE'), primary_key=True)
+    department = db.Column(db.String(100), nullable=False)
+    first_punch = db.Column(db.DateTime, nullable=False)
+    last_punch = db.Column(db.DateTime, nullable=False)
+    punch_count = db.Column(db.Integer, nullable=False, default=1)
+
+class DailyDepartmentAttendance(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    department = db.Column(db.String(100), primary_key=True)
+    present_count = db.Column(db.Integer, nullable=False, default=0)
+
+def day_range(d):
+    # Half-open [start, end) so day filters can use the timestamp indexes.
+    start = datetime.combine(d, time.min)
+    return start, start + timedelta(days=1)
+
+SAME_DAY_DUPLICATES = (
+    "SELECT id FROM attendance WHERE id NOT IN "
+    "(SELECT MIN(id) FROM attendance GROUP BY employee_id, day)"
+)
+
+def add_day_column():
+    if 'day' not in {c['name'] for c in db.inspect(db.engine).get_columns('attendance')}:
+        with db.engine.begin() as conn:
+            conn.execute(db.text("ALTER TABLE attendance ADD COLUMN day DATE"))
+            conn.execute(db.text("UPDATE attendance SET day = date(timestamp)"))
+
+def upgrade_schema():
+    # create_all() only creates missing tables. Bring older databases up to
+    # date: add and fill attendance.day, add the enrollment job ownership
+    # columns, then create missing indexes. Never
+    # deletes anything; same-day duplicates must be removed explicitly with
+    # "python attendance.py dedupe" before the unique index can be built.
+    add_day_column()
+    inspector = db.inspect(db.engine)
+    job_columns = {c['name'] for c in inspector.get_columns('enrollment_job')}
+    with db.engine.begin() as conn:
+        for name, ddl in (('owner', 'VARCHAR(36)'), ('raw_path', 'VARCHAR(300)')):
+            if name not in job_columns:
+                conn.execute(db.text(f"ALTER TABLE enrollment_job ADD COLUMN {name} {ddl}"))
+    existing = {i['name'] for i in inspector.get_indexes('attendance')}
+    if 'uq_attendance_employee_day' not in existing:
+        with db.engine.connect() as conn:
+            duplicates = conn.execute(db.text(f"SELECT count(*) FROM ({SAME_DAY_DUPLICATES})")).scalar()
+        if duplicates:
+            raise RuntimeError(
+                f"{duplicates} attendance rows duplicate an earlier punch on the same day; "
+                "review them and run 'python attendance.py dedupe' to remove them"
+            )
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+def configure_sqlite(app):
+    # WAL lets kiosks keep reading while one writer commits; the busy
+    # timeout itself comes from SQLALCHEMY_ENGINE_OPTIONS connect_args.
+    if not app.config["SQLITE_WAL"]:
+        return
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name != "sqlite":
+        return
+
+    @db.event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
@@ -0,0 +1,86 @@
+import cv2
+import numpy as np
+import face_recognition
+from metrics import stage
+
+
+def decode_image(data):
+    # JPEG/PNG bytes straight from the upload, no temp file. Returns BGR or None.
+    if not data:
+        return None
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def face_quality(gray, location):
+    # Sharpness (variance of the Laplacian) weighted by face size, so a
+    # blurry or distant face loses to a crisp close one.
+    top, right, bottom, left = location
+    crop = gray[max(top, 0):bottom, max(left, 0):right]
+    if crop.size == 0:
+        return 0.0
+    sharpness = cv2.Laplacian(crop, cv2.CV_64F).var()
+    return float(sharpness * np.sqrt(crop.shape[0] * crop.shape[1]))
+
+
+def scale_location(location, scale, shape):
+    top, right, bottom, left = (int(round(v / scale)) for v in location)
+    h, w = shape[:2]
+    return max(top, 0), min(right, w), min(bottom, h), max(left, 0)
+
+
+def best_face(frames, scale=0.5):
+    # Detects on a downscaled copy of every frame and returns
+    # (rgb_frame, full_size_location, quality) for the best face, or None.
+    best = None
+    for frame in frames:
+        if frame is None:
+            continue
+        small = cv2.resize(frame, (0, 0), fx=scale, fy=scale)
+        locations = face_recognition.face_locations(cv2.cvtColor(small, cv2.COLOR_BGR2RGB))
+        if not locations:
+            continue
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        for location in locations:
+            quality = face_quality(gray, location)
+            if best is None or quality > best[2]:
+                best = (frame, location, quality)
+    if best is None:
+        return None
+    frame, location, quality = best
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), scale_location(location, scale, frame.shape), quality
+
+
+def encode_best(frames, scale=0.5):
+    with stage("detect"):
+        found = best_face(frames, scale)
+    if found is None:
+        return None, 0.0
+    rgb, location, quality = found
+    with stage("encode"):
+        encs = face_recognition.face_encodings(rgb, known_face_locations=[location])
+    return (encs[0] if encs else None), quality
+
+
+def confidence(match, tolerance):
+    return round(max(0.0, 1.0 - match.distance / tolerance), 3)
+
+
+def encode_all(frame, scale=0.5, max_faces=None):
+    # Group mode: every face in one frame, largest first, encoded in a single
+    # face_encodings call. Returns [(full_size_location, encoding, quality)].
+    if frame is None:
+        return []
+    with stage("detect"):
+        small = cv2.resize(frame, (0, 0), fx=scale, fy=scale)
+        locations = face_recognition.face_locations(cv2.cvtColor(small, cv2.COLOR_BGR2RGB))
+        locations.sort(key=lambda l: (l[2] - l[0]) * (l[1] - l[3]), reverse=True)
+        if max_faces:
+            locations = locations[:max_faces]
+    if not locations:
+        return []
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    qualities = [face_quality(gray, l) for l in locations]
+    full = [scale_location(l, scale, frame.shape) for l in locations]
+    with stage("encode"):
+        encs = face_recognition.face_encodings(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), known_face_locations=full)
+    return list(zip(full, encs, qualities))
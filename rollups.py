@@ -0,0 +1,140 @@
+import sys
+import calendar
+from datetime import date
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, Employee, Attendance, DailyAttendance, DailyDepartmentAttendance
+
+
+def record_punch(employee, timestamp):
+    # Called in the same transaction as the Attendance insert. Both upserts
+    # are single statements, so concurrent punches cannot double count.
+    day = timestamp.date()
+    inserted = db.session.execute(
+        sqlite_insert(DailyAttendance)
+        .values(day=day, employee_id=employee.id, department=employee.department,
+                first_punch=timestamp, last_punch=timestamp, punch_count=1)
+        .on_conflict_do_nothing(index_elements=["day", "employee_id"])
+    ).rowcount
+    if not inserted:
+        db.session.execute(
+            db.update(DailyAttendance)
+            .where(DailyAttendance.day == day, DailyAttendance.employee_id == employee.id)
+            .values(
+                first_punch=db.func.min(DailyAttendance.first_punch, timestamp),
+                last_punch=db.func.max(DailyAttendance.last_punch, timestamp),
+                punch_count=DailyAttendance.punch_count + 1,
+            )
+        )
+        return
+    stmt = sqlite_insert(DailyDepartmentAttendance).values(
+        day=day, department=employee.department, present_count=1
+    )
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=["day", "department"],
+        set_={"present_count": DailyDepartmentAttendance.present_count + 1},
+    ))
+
+
+def forget_employee(employee_id):
+    # SQLite does not enforce foreign keys here (and older databases lack
+    # ON DELETE CASCADE), so deleting an employee would leave their rollups
+    # behind. Remove their employee-days and take them out of the
+    # department counts, in the caller's transaction.
+    own_day = db.select(DailyAttendance.day).where(
+        DailyAttendance.employee_id == employee_id,
+        DailyAttendance.day == DailyDepartmentAttendance.day,
+        DailyAttendance.department == DailyDepartmentAttendance.department,
+    )
+    db.session.execute(
+        db.update(DailyDepartmentAttendance)
+        .where(own_day.exists())
+        .values(present_count=DailyDepartmentAttendance.present_count - 1)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        db.delete(DailyDepartmentAttendance).where(DailyDepartmentAttendance.present_count <= 0)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        db.delete(DailyAttendance).where(DailyAttendance.employee_id == employee_id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def backfill():
+    db.session.execute(db.delete(DailyDepartmentAttendance))
+    db.session.execute(db.delete(DailyAttendance))
+    day = db.func.date(Attendance.timestamp)
+    db.session.execute(db.insert(DailyAttendance).from_select(
+        ["day", "employee_id", "department", "first_punch", "last_punch", "punch_count"],
+        db.select(
+            day, Attendance.employee_id, Employee.department,
+            db.func.min(Attendance.timestamp), db.func.max(Attendance.timestamp), db.func.count(),
+        ).join(Employee).group_by(day, Attendance.employee_id),
+    ))
+    db.session.execute(db.insert(DailyDepartmentAttendance).from_select(
+        ["day", "department", "present_count"],
+        db.select(DailyAttendance.day, DailyAttendance.department, db.func.count())
+        .group_by(DailyAttendance.day, DailyAttendance.department),
+    ))
+    db.session.commit()
+    return db.session.scalar(db.select(db.func.count()).select_from(DailyAttendance))
+
+
+def present_count(day):
+    return db.session.scalar(
+        db.select(db.func.coalesce(db.func.sum(DailyDepartmentAttendance.present_count), 0))
+        .where(DailyDepartmentAttendance.day == day)
+    )
+
+
+def monthly_department_report(year, month):
+    # Attendance % = employee-days present / (headcount * days with any
+    # attendance that month). Headcount is the department's current size.
+    start = date(year, month, 1)
+    end = date(year, month, calendar.monthrange(year, month)[1])
+    in_month = db.and_(DailyDepartmentAttendance.day >= start, DailyDepartmentAttendance.day <= end)
+    working_days = db.session.scalar(
+        db.select(db.func.count(db.distinct(DailyDepartmentAttendance.day))).where(in_month)
+    )
+    present = dict(db.session.execute(
+        db.select(DailyDepartmentAttendance.department, db.func.sum(DailyDepartmentAttendance.present_count))
+        .where(in_month)
+        .group_by(DailyDepartmentAttendance.department)
+    ).all())
+    headcount = dict(db.session.execute(
+        db.select(Employee.department, db.func.count()).group_by(Employee.department)
+    ).all())
+    report = []
+    for department in sorted(set(headcount) | set(present)):
+        possible = headcount.get(department, 0) * working_days
+        days_present = present.get(department, 0)
+        report.append({
+            "department": department,
+            "headcount": headcount.get(department, 0),
+            "days_present": days_present,
+            "percentage": round(100.0 * days_present / possible, 1) if possible else 0.0,
+        })
+    return working_days, report
+
+
+def absentees(day):
+    return (
+        Employee.query.outerjoin(
+            DailyAttendance,
+            db.and_(DailyAttendance.employee_id == Employee.id, DailyAttendance.day == day),
+        )
+        .filter(DailyAttendance.employee_id.is_(None))
+        .order_by(Employee.department, Employee.name)
+        .all()
+    )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["backfill"]:
+        print("usage: python rollups.py backfill")
+        sys.exit(2)
+    from app import app
+    with app.app_context():
+        db.create_all()
+        print(f"Rebuilt {backfill()} employee-day rollups")